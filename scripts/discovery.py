@@ -5,12 +5,24 @@ Builds mapping.json  {templateId: [templateId, dup1Id, dup2Id, …]}
 and last_seen.json   {sheetId: modifiedAt_iso}
 Optimised: only hits the API for sheets modified since last run.
 """
-import os, re, json, time, argparse, datetime as dt
+import os, re, time, asyncio, argparse, datetime as dt
 from pathlib import Path
+from aiolimiter import AsyncLimiter
+import orjson
 import smartsheet
+from mapping_io import load_mapping, save_packed, write_if_changed
 
 SDK = smartsheet.Smartsheet(os.getenv("SMARTSHEET_TOKEN"))
 WS_ID = int(os.getenv("WORKSPACE_ID", "0"))
+RATE = AsyncLimiter(250, 60)           # stay under 300 req/min
+JSON_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
+async def safe(fn, *a, **kw):
+    async with RATE:
+        loop = asyncio.get_running_loop()
+        from functools import partial
+        func = partial(fn, *a, **kw)
+        return await loop.run_in_executor(None, func)
 
 def normalise(name: str) -> str:
     """Strip '‑ Copy (1)' etc.  Fallback when no summary field exists."""
@@ -19,136 +31,179 @@ def normalise(name: str) -> str:
 def load_cache(path: Path) -> dict:
     if path.exists() and path.stat().st_size > 0:
         try:
-            return json.loads(path.read_text())
-        except (json.JSONDecodeError, ValueError):
+            return orjson.loads(path.read_bytes())
+        except (orjson.JSONDecodeError, ValueError):
             return {}
     return {}
 
-def save_json(path: Path, obj):
-    tmp = path.with_suffix(".tmp")
-    tmp.write_text(json.dumps(obj, indent=2))
-    tmp.replace(path)
+def save_json(path: Path, obj) -> bool:
+    """Atomic write; returns False (and touches nothing) when the file is unchanged."""
+    return write_if_changed(path, orjson.dumps(obj, option=JSON_OPTS))
 
-def get_all_sheets_recursive(workspace_id: int) -> list:
+async def get_all_sheets_recursive(workspace_id: int) -> list:
     """Recursively get all sheets from workspace and all nested folders"""
     all_sheets = []
     
     # Get workspace with sheets and folders
-    ws = SDK.Workspaces.get_workspace(workspace_id, include="sheets,folders")
+    ws = await safe(SDK.Workspaces.get_workspace, workspace_id, include="sheets,folders")
     
     # Add direct sheets in workspace
     if hasattr(ws, 'sheets') and ws.sheets:
         all_sheets.extend(ws.sheets)
     
-    # Recursively process folders
+    # Walk the folder tree level by level
     if hasattr(ws, 'folders') and ws.folders:
-        for folder in ws.folders:
-            all_sheets.extend(get_folder_sheets_recursive(folder.id))
+        all_sheets.extend(await get_folder_sheets_recursive([f.id for f in ws.folders]))
     
     return all_sheets
 
-def get_folder_sheets_recursive(folder_id: int) -> list:
-    """Recursively get all sheets from a folder and its subfolders"""
-    sheets = []
-    
+async def get_folder_contents(folder_id: int) -> tuple[list, list]:
+    """Return (sheets, subfolder ids) for a single folder"""
     try:
-        folder_contents = SDK.Folders.get_folder(folder_id, include="sheets,folders")
-        
-        # Add sheets in this folder
-        if hasattr(folder_contents, 'sheets') and folder_contents.sheets:
-            sheets.extend(folder_contents.sheets)
-        
-        # Recursively process subfolders
-        if hasattr(folder_contents, 'folders') and folder_contents.folders:
-            for subfolder in folder_contents.folders:
-                sheets.extend(get_folder_sheets_recursive(subfolder.id))
-                
+        folder_contents = await safe(SDK.Folders.get_folder, folder_id, include="sheets,folders")
     except Exception as e:
         print(f"Warning: Could not access folder {folder_id}: {e}")
+        return [], []
+    
+    sheets = folder_contents.sheets if getattr(folder_contents, 'sheets', None) else []
+    folders = folder_contents.folders if getattr(folder_contents, 'folders', None) else []
+    return list(sheets), [f.id for f in folders]
+
+async def get_folder_sheets_recursive(folder_ids: list) -> list:
+    """Breadth-first walk of the given folders and their subfolders.
+    Every folder on the same level is fetched concurrently, so wall time
+    follows the depth of the tree rather than the number of folders."""
+    sheets = []
+    level = list(folder_ids)
+    
+    while level:
+        results = await asyncio.gather(*(get_folder_contents(fid) for fid in level))
+        level = []
+        for folder_sheets, subfolder_ids in results:
+            sheets.extend(folder_sheets)
+            level.extend(subfolder_ids)
     
     return sheets
 
-def detect_rollup_sheets(all_sheets: list) -> list:
+async def is_rollup_sheet(sheet) -> bool:
+    """True if the sheet has formulas with cross-sheet references"""
+    try:
+        # A sheet without cross-sheet references cannot be a rollup;
+        # the reference listing is far smaller than the formula payload
+        refs = await safe(SDK.Sheets.list_cross_sheet_references, sheet.id)
+        ref_ct = getattr(refs, 'total_count', None) or len(getattr(refs, 'data', None) or [])
+        if not ref_ct:
+            return False
+        
+        # Get sheet with formulas to check for cross-sheet references
+        sheet_data = await safe(SDK.Sheets.get_sheet, sheet.id, include="formulas", level=1)
+    except Exception:
+        # Skip sheets we can't access (permissions, etc.)
+        return False
+    
+    # Look for formulas with cross-sheet references (contain {}); stops at the first hit
+    return any(
+        '{' in f and '}' in f
+        for row in (getattr(sheet_data, 'rows', None) or ())
+        for cell in (getattr(row, 'cells', None) or ())
+        if (f := getattr(cell, 'formula', None))
+    )
+
+async def detect_rollup_sheets(all_sheets: list) -> list:
     """Automatically detect sheets with cross-sheet formulas (rollup sheets)"""
-    rollup_sheets = []
+    sem = asyncio.Semaphore(32)          # sheets checked at once; RATE still caps req/min
     
-    for sheet in all_sheets:
-        try:
-            # Get sheet with formulas to check for cross-sheet references
-            sheet_data = SDK.Sheets.get_sheet(sheet.id, include="formulas", level=1)
-            
-            # Look for formulas with cross-sheet references (contain {})
-            has_cross_sheet_formulas = False
-            
-            if hasattr(sheet_data, 'rows') and sheet_data.rows:
-                for row in sheet_data.rows:
-                    if hasattr(row, 'cells') and row.cells:
-                        for cell in row.cells:
-                            if hasattr(cell, 'formula') and cell.formula:
-                                # Check if formula contains cross-sheet references {}
-                                if '{' in cell.formula and '}' in cell.formula:
-                                    has_cross_sheet_formulas = True
-                                    break
-                    if has_cross_sheet_formulas:
-                        break
-            
-            if has_cross_sheet_formulas:
-                rollup_sheets.append(sheet.id)
-                print(f"🔗 Auto-detected rollup sheet: {sheet.name} (ID: {sheet.id})")
-                
-        except Exception as e:
-            # Skip sheets we can't access (permissions, etc.)
-            continue
+    async def check(sheet) -> bool:
+        async with sem:
+            return await is_rollup_sheet(sheet)
+    
+    flags = await asyncio.gather(*(check(s) for s in all_sheets))
+    
+    rollup_sheets = []
+    for sheet, is_rollup in zip(all_sheets, flags):
+        if is_rollup:
+            rollup_sheets.append(sheet.id)
+            print(f"🔗 Auto-detected rollup sheet: {sheet.name} (ID: {sheet.id})")
     
     return rollup_sheets
 
 def save_rollup_config(rollup_ids: list):
     """Save detected rollup IDs to a config file"""
-    import json
+    path = Path("auto_rollup_config.json")
+    prev = load_cache(path)
+    # keep the old timestamp when nothing changed so the file (and git) stay untouched
+    if prev.get("auto_detected_rollup_ids") == rollup_ids and "detected_at" in prev:
+        detected_at = prev["detected_at"]
+    else:
+        detected_at = dt.datetime.now().isoformat()
     config = {
         "auto_detected_rollup_ids": rollup_ids,
-        "detected_at": dt.datetime.now().isoformat(),
+        "detected_at": detected_at,
         "count": len(rollup_ids)
     }
     
-    with open("auto_rollup_config.json", "w") as f:
-        json.dump(config, f, indent=2)
+    save_json(path, config)
     
     print(f"✅ Auto-detected {len(rollup_ids)} rollup sheets saved to auto_rollup_config.json")
 
-def build_index(workspace_id: int, since_cache: dict) -> tuple[dict, dict]:
-    # Get ALL sheets recursively from workspace and nested folders
-    all_sheets = get_all_sheets_recursive(workspace_id)
-    mapping, last_seen = {}, {}
+async def get_source_id(sheet) -> str:
+    """Template key for a sheet: its OriginalSheetId tag, else the naming convention"""
+    # 1️⃣ look for Sheet‑Summary field "OriginalSheetId"
+    src_id = None
+    try:
+        meta = await safe(SDK.Sheets.get_sheet_summary_fields, sheet.id)
+        if hasattr(meta, 'data'):
+            summary_fields = meta.data
+        else:
+            summary_fields = meta
+        summary = {f.title: getattr(f, 'display_value', getattr(f, 'value', None)) for f in summary_fields}
+        src_id = summary.get("OriginalSheetId")
+    except Exception:
+        pass
+
+    # 2️⃣ fallback: naming convention
+    if not src_id:
+        src_id = str(sheet.id) if 'template' in sheet.name.lower() else normalise(sheet.name)
+    return src_id
+
+async def build_index(all_sheets: list, since_cache: dict, prev_mapping: dict) -> tuple[dict, dict]:
+    """Merge into the previous mapping: only sheets that changed (or that the
+    previous mapping does not know) are re-probed; every other entry carries over."""
+    last_seen, changed = {}, []
+    known = {int(i) for ids in prev_mapping.values() for i in ids}
     
     for s in all_sheets:
         mod = s.modified_at.isoformat()
         last_seen[str(s.id)] = mod
         # skip unchanged sheets
-        if since_cache.get(str(s.id)) == mod:
-            continue
+        if since_cache.get(str(s.id)) != mod or int(s.id) not in known:
+            changed.append(s)
 
-        # 1️⃣ look for Sheet‑Summary field "OriginalSheetId"
-        src_id = None
-        try:
-            meta = SDK.Sheets.get_sheet_summary_fields(s.id)
-            if hasattr(meta, 'data'):
-                summary_fields = meta.data
-            else:
-                summary_fields = meta
-            summary = {f.title: getattr(f, 'display_value', getattr(f, 'value', None)) for f in summary_fields}
-            src_id = summary.get("OriginalSheetId")
-        except Exception:
-            pass
-
-        # 2️⃣ fallback: naming convention
-        if not src_id:
-            src_id = str(s.id) if 'template' in s.name.lower() else normalise(s.name)
-
-        mapping.setdefault(src_id, []).append(int(s.id))
+    # summary probes are independent -> fetch them together under RATE
+    sem = asyncio.Semaphore(32)          # sheets probed at once, as in detect_rollup_sheets
+    
+    async def probe(sheet) -> str:
+        async with sem:
+            return await get_source_id(sheet)
+    
+    src_ids = await asyncio.gather(*(probe(s) for s in changed))
+    new_src = {int(s.id): src_id for s, src_id in zip(changed, src_ids)}
+
+    # carry groups over in their old order, dropping deleted sheets and
+    # changed sheets that now belong to a different template
+    present = {int(s.id) for s in all_sheets}
+    mapping = {}
+    for tid, ids in prev_mapping.items():
+        kept = [int(i) for i in ids if int(i) in present and new_src.get(int(i), tid) == tid]
+        if kept:
+            mapping[tid] = kept
+    for sid, tid in new_src.items():
+        group = mapping.setdefault(tid, [])
+        if sid not in group:
+            group.append(sid)
     return mapping, last_seen
 
-if __name__ == "__main__":
+async def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--workspace", type=int, default=WS_ID)
     ap.add_argument("--out", default="mapping.json")
@@ -158,15 +213,24 @@ if __name__ == "__main__":
     args = ap.parse_args()
 
     since_cache = load_cache(Path(args.since_cache))
-    mapping, last_seen = build_index(args.workspace, since_cache)
+    try:
+        prev_mapping = load_mapping(args.out)
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        prev_mapping = {}
+    # Get ALL sheets recursively from workspace and nested folders (walked once)
+    all_sheets = await get_all_sheets_recursive(args.workspace)
+    mapping, last_seen = await build_index(all_sheets, since_cache, prev_mapping)
 
     save_json(Path(args.out), mapping)
+    save_packed(args.out, mapping)
     save_json(Path(args.since_cache), last_seen)
     print(f"✓ mapping.json refreshed — {len(mapping)} template groups")
     
     # Auto-detect rollup sheets if requested
     if args.detect_rollups:
         print("🔍 Auto-detecting rollup sheets with cross-sheet formulas...")
-        all_sheets = get_all_sheets_recursive(args.workspace)
-        rollup_ids = detect_rollup_sheets(all_sheets)
+        rollup_ids = await detect_rollup_sheets(all_sheets)
         save_rollup_config(rollup_ids)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+mapping_io.py
+mapping.json is the committed source of truth; discovery also writes
+mapping.msgpack beside it (local only, rebuilt every run, never committed),
+which decodes much faster. Loaders prefer the packed copy and fall back to
+JSON when it is missing, older than the JSON, or unreadable.
+Writes are atomic and skipped when the bytes on disk already match.
+"""
+import os
+from pathlib import Path
+import msgpack, orjson
+
+def write_if_changed(path, data: bytes) -> bool:
+    """Atomically replace *path* with *data*; no-op (False) when unchanged."""
+    path = Path(path)
+    try:
+        if path.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())             # data on disk before the rename publishes it
+    os.replace(tmp, path)
+    return True
+
+def packed_path(path) -> Path:
+    return Path(path).with_suffix(".msgpack")
+
+def save_packed(path, obj) -> bool:
+    """Write obj as MessagePack next to *path* (mapping.json -> mapping.msgpack)."""
+    return write_if_changed(packed_path(path), msgpack.packb(obj, use_bin_type=True))
+
+def load_mapping(path) -> dict:
+    """Load {templateId: [sheetId, …]}, using the packed copy unless the JSON is newer."""
+    src, packed = Path(path), packed_path(path)
+    if packed.exists() and (not src.exists() or packed.stat().st_mtime >= src.stat().st_mtime):
+        try:
+            return msgpack.unpackb(packed.read_bytes())
+        except (ValueError, msgpack.UnpackException) as e:
+            if not src.exists():
+                raise
+            print(f"Warning: ignoring unreadable {packed}: {e}")
+    return orjson.loads(src.read_bytes())
@@ -3,98 +3,74 @@
 monitor_and_duplicate.py
 • Loops through every sheet group in mapping.json
 • For each 'latest' sheet in that group, checks error conditions
-• If errors ⇒ duplicates the sheet, wipes its rows, tags it with OriginalSheetId
+• If errors ⇒ duplicates the sheet without its rows, tags it with OriginalSheetId
 """
-import os, json, asyncio
+import os, asyncio
 from datetime import datetime as dt
-from aiolimiter import AsyncLimiter
-import smartsheet
+import ss_client
+from mapping_io import load_mapping
 
 # ---------- CONFIGURABLE THRESHOLDS ----------
 ERR_CELL_LIMIT       = int(os.getenv("ERR_CELL_LIMIT", 1))
 ERR_REF_LIMIT        = int(os.getenv("ERR_REF_LIMIT", 95))
 ERR_CELLCOUNT_LIMIT  = int(os.getenv("ERR_CELLCOUNT_LIMIT", 4_800_000))
-RATE = AsyncLimiter(250, 60)           # stay under 300 req/min
-SDK  = smartsheet.Smartsheet(os.getenv("SMARTSHEET_TOKEN"))
+GROUP_CONCURRENCY    = int(os.getenv("GROUP_CONCURRENCY", 64))   # groups checked at once
 WS_ID = int(os.getenv("WORKSPACE_ID", "0"))
 
 # ---------- HELPERS ----------
-async def safe(fn, *a, **kw):
-    async with RATE:
-        loop = asyncio.get_running_loop()
-        from functools import partial
-        func = partial(fn, *a, **kw)
-        return await loop.run_in_executor(None, func)
-
 async def duplicate_blank(src_id: int) -> int:
-    """Copy sheet, then wipe all rows (blank duplicate)."""
+    """Copy sheet structure only (no rows), then tag it (blank duplicate)."""
     name = f"{dt.now():%Y‑%m‑%d} Duplicate of {src_id}"
     
-    # Create copy request - use basic dict instead of model class
-    copy_request = {
-        "destination_type": "workspace",
-        "destination_id": WS_ID,
-        "new_name": name,
-        "include": ["data"]
-    }
-    
     try:
-        copy_result = await safe(SDK.Sheets.copy_sheet, src_id, copy_request)
-        new_id = copy_result.result.id if hasattr(copy_result, 'result') else copy_result.id
+        # no include=data -> columns/formatting only, nothing to delete afterwards
+        copy_result = await ss_client.copy_sheet(src_id, "workspace", WS_ID, name)
+        new_id = copy_result["id"]
     except Exception as e:
         print(f"Error copying sheet: {e}")
         return None
 
-    # tag summary with OriginalSheetId using dict instead of model
-    summary_request = {
-        "summaryFields": [{
-            "title": "OriginalSheetId",
-            "type": "TEXT_NUMBER",
-            "value": str(src_id)
-        }]
-    }
+    # tag summary with OriginalSheetId
+    summary_fields = [{
+        "title": "OriginalSheetId",
+        "type": "TEXT_NUMBER",
+        "objectValue": str(src_id)
+    }]
     
     try:
-        await safe(SDK.Sheets.update_sheet_summary_fields, new_id, summary_request)
+        await ss_client.add_summary_fields(new_id, summary_fields)
     except Exception as e:
         print(f"Error adding OriginalSheetId tag: {e}")
 
-    # delete all rows (blank it)
-    try:
-        sheet = await safe(SDK.Sheets.get_sheet, new_id, level=1)
-        if hasattr(sheet, 'rows') and sheet.rows:
-            await safe(SDK.Sheets.delete_rows, new_id, [r.id for r in sheet.rows])
-    except Exception as e:
-        print(f"Error deleting rows: {e}")
-        
     print(f"⚠️  Sheet {src_id} duplicated → {new_id} (blank) due to errors")
     return new_id
 
 async def needs_rollover(sheet_id: int) -> bool:
     """Return True if the sheet trips any error thresholds."""
     try:
-        sheet = await safe(SDK.Sheets.get_sheet, sheet_id, include="formulas,data", level=1)
+        sheet = await ss_client.get_sheet(sheet_id, include="formulas,data", level=1)
+        rows = sheet.get("rows", [])
         
         # 1️⃣ cell errors
         err_cells = sum(
-            1 for r in sheet.rows for c in r.cells
-            if c.display_value and str(c.display_value).startswith('#')
+            1 for r in rows for c in r.get("cells", [])
+            if c.get("displayValue") and str(c["displayValue"]).startswith('#')
         )
         if err_cells >= ERR_CELL_LIMIT:
             return True
 
         # 2️⃣ reference utilisation
         try:
-            refs = await safe(SDK.Sheets.list_cross_sheet_references, sheet_id)
-            ref_ct = refs.total_count if hasattr(refs, 'total_count') else (len(refs.data) if hasattr(refs, 'data') else 0)
+            refs = await ss_client.list_xrefs(sheet_id)
+            ref_ct = refs.get("totalCount", len(refs.get("data", [])))
             if ref_ct >= ERR_REF_LIMIT:
                 return True
-        except Exception:
+        except Exception as e:
             # If we can't check references, assume 0
-            pass
+            print(f"Warning: could not count references on {sheet_id}: {e}")
 
         # 3️⃣ cell capacity
-        if (sheet.total_row_count or len(sheet.rows)) * len(sheet.columns) >= ERR_CELLCOUNT_LIMIT:
+        if (sheet.get("totalRowCount") or len(rows)) * len(sheet.get("columns", [])) >= ERR_CELLCOUNT_LIMIT:
             return True
 
         return False
@@ -118,8 +94,17 @@ async def monitor_group(template_id: str, sheets: list[int]):
         await duplicate_blank(original_sheet_id)
 
 async def main():
-    mapping = json.load(open("mapping.json"))
-    await asyncio.gather(*(monitor_group(tid, sids) for tid, sids in mapping.items()))
+    mapping = load_mapping("mapping.json")
+    sem = asyncio.Semaphore(GROUP_CONCURRENCY)
+
+    async def bounded(tid: str, sids: list[int]):
+        async with sem:
+            await monitor_group(tid, sids)
+
+    try:
+        await asyncio.gather(*(bounded(tid, sids) for tid, sids in mapping.items()))
+    finally:
+        await ss_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
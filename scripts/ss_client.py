@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+ss_client.py
+Thin async client for the Smartsheet REST API, shared by updater and monitor.
+Every call goes through one aiohttp session and one rate limiter, so no
+thread‑pool hop is needed and all scripts stay under the same budget.
+Responses are returned as plain JSON dicts (camelCase keys, as the API sends them).
+"""
+import os, time, asyncio
+import aiohttp, orjson
+from aiolimiter import AsyncLimiter
+
+API   = "https://api.smartsheet.com/2.0"
+TOKEN = os.getenv("SMARTSHEET_TOKEN")
+RATE  = AsyncLimiter(290, 60)          # one bucket for every caller, under 300 req/min
+
+# ---------- AIMD BACKPRESSURE ----------
+# RATE caps requests per minute; the gate below caps requests in flight and
+# adapts to the server: halve on 429/5xx, creep back up after a healthy window.
+MAX_INFLIGHT   = 64                    # same as limit_per_host
+MIN_INFLIGHT   = 4
+AIMD_BETA      = 0.5                   # multiplicative decrease on throttling
+AIMD_ALPHA     = 0.5                   # additive increase per healthy window
+AIMD_WINDOW    = 50                    # consecutive successes per window
+LATENCY_TARGET = float(os.getenv("SS_LATENCY_TARGET", 2.0))   # seconds, window average
+
+class _Backpressure:
+    def __init__(self, start: float):
+        self.limit    = start
+        self.inflight = 0
+        self.streak   = 0
+        self.elapsed  = 0.0
+        self.cut_at   = 0.0                # monotonic time of the last decrease
+        self.cond     = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, throttled: bool, started: float, elapsed: float):
+        async with self.cond:
+            self.inflight -= 1
+            if throttled:
+                # one cut per congestion window: requests sent before the last
+                # cut were already accounted for by it
+                if started >= self.cut_at:
+                    self.limit  = max(MIN_INFLIGHT, self.limit * AIMD_BETA)
+                    self.cut_at = time.monotonic()
+                self.streak, self.elapsed = 0, 0.0
+            else:
+                self.streak  += 1
+                self.elapsed += elapsed
+                if self.streak >= AIMD_WINDOW:
+                    if self.elapsed / self.streak <= LATENCY_TARGET:
+                        self.limit = min(MAX_INFLIGHT, self.limit + AIMD_ALPHA)
+                    self.streak, self.elapsed = 0, 0.0
+            self.cond.notify_all()
+
+GATE = _Backpressure(MAX_INFLIGHT / 2)
+
+# ---------- RETRY‑AFTER ----------
+RETRY_STATUS = (429, 503)
+MAX_RETRIES  = 5
+_resume_at   = 0.0                     # monotonic time before which no caller hits the API
+
+def _retry_delay(headers, attempt: int) -> float:
+    """Server's Retry-After (seconds) if given, else exponential backoff."""
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return float(2 ** attempt)
+
+async def _wait_for_resume():
+    # loop: another 429 may push _resume_at further out while we sleep
+    while (delay := _resume_at - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+
+_session = None
+
+def session() -> aiohttp.ClientSession:
+    """Lazily open the shared session (must be called inside the event loop)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers={"Authorization": f"Bearer {TOKEN}"},
+            connector=aiohttp.TCPConnector(limit_per_host=64),
+            json_serialize=lambda o: orjson.dumps(o).decode(),
+        )
+    return _session
+
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _params(**kw) -> dict:
+    """Drop unset query params and render booleans the way the API expects."""
+    return {k: (str(v).lower() if isinstance(v, bool) else str(v))
+            for k, v in kw.items() if v is not None}
+
+async def request(method: str, path: str, *, params: dict | None = None, json=None):
+    global _resume_at
+    for attempt in range(MAX_RETRIES + 1):
+        await _wait_for_resume()             # don't queue up while paused …
+        await GATE.acquire()
+        throttled, t0, elapsed = False, 0.0, 0.0
+        try:
+            async with RATE:
+                await _wait_for_resume()     # … and re-check after queueing, right before sending
+                t0 = time.monotonic()
+                async with session().request(method, f"{API}{path}", params=params, json=json) as resp:
+                    throttled = resp.status == 429 or resp.status >= 500
+                    elapsed = time.monotonic() - t0
+                    if resp.status not in RETRY_STATUS or attempt == MAX_RETRIES:
+                        resp.raise_for_status()
+                        return await resp.json(loads=orjson.loads)
+                    delay = _retry_delay(resp.headers, attempt)
+        finally:
+            await GATE.release(throttled, t0, elapsed)
+        # pause every caller, not just this one: the limit is per token
+        _resume_at = max(_resume_at, time.monotonic() + delay)
+
+# ---------- SHEETS ----------
+async def get_sheet(sheet_id: int, include: str | None = None, level: int | None = None) -> dict:
+    return await request("GET", f"/sheets/{sheet_id}",
+                         params=_params(include=include, level=level))
+
+async def copy_sheet(sheet_id: int, destination_type: str, destination_id: int,
+                     new_name: str, include: str | None = None) -> dict:
+    body = {"destinationType": destination_type,
+            "destinationId": destination_id,
+            "newName": new_name}
+    res = await request("POST", f"/sheets/{sheet_id}/copy",
+                        params=_params(include=include), json=body)
+    return res["result"]
+
+async def add_summary_fields(sheet_id: int, fields: list[dict]) -> list:
+    res = await request("POST", f"/sheets/{sheet_id}/summary/fields", json=fields)
+    return res["result"]
+
+# ---------- ROWS ----------
+async def update_rows(sheet_id: int, rows: list[dict]) -> list:
+    res = await request("PUT", f"/sheets/{sheet_id}/rows", json=rows)
+    return res["result"]
+
+# ---------- CROSS‑SHEET REFERENCES ----------
+async def list_xrefs(sheet_id: int) -> dict:
+    """Full listing: {"totalCount": n, "data": [ref, …]}"""
+    return await request("GET", f"/sheets/{sheet_id}/crosssheetreferences",
+                         params=_params(includeAll=True))
+
+async def create_xref(sheet_id: int, ref: dict) -> dict:
+    res = await request("POST", f"/sheets/{sheet_id}/crosssheetreferences", json=ref)
+    return res["result"]
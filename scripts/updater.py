@@ -4,87 +4,115 @@ updater.py
 Clones *active* cross‑sheet references for every duplicate sheet
 and appends the new token to the formulas that already use the old token.
 """
-import os, re, json, asyncio, argparse
+import os, re, asyncio, argparse, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from itertools import islice
-from aiolimiter import AsyncLimiter
-import smartsheet
+import orjson
+import ss_client
+from mapping_io import load_mapping
 
-SDK = smartsheet.Smartsheet(os.getenv("SMARTSHEET_TOKEN"))
-RATE = AsyncLimiter(300, 60)          # 300 calls / min  :contentReference[oaicite:1]{index=1}
+# bounds copied from the template reference onto every duplicate reference
+REF_BOUNDS = ("startRowId", "endRowId", "startColumnId", "endColumnId")
+_TOKEN_RE = re.compile(r'\{([^{}]+)\}')   # {Reference Name} inside a formula
 
-async def safe(fn, *a, **kw):
-    async with RATE:
-        loop = asyncio.get_running_loop()
-        from functools import partial
-        func = partial(fn, *a, **kw)
-        return await loop.run_in_executor(None, func)
+_POOL = None                          # formula patching runs off the event loop
 
 def chunked(it, n=490):               # 500 rows max / request  :contentReference[oaicite:2]{index=2}
     it = iter(it)
     return iter(lambda: list(islice(it, n)), [])
 
+def pool() -> ProcessPoolExecutor:
+    global _POOL
+    if _POOL is None:
+        # spawn, not fork: by now aiohttp's resolver threads are running,
+        # and forking a multi-threaded process can deadlock the children
+        _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _POOL
+
+def _patch_rows(rows: list, repl_map: dict) -> list[dict]:
+    """rows: [(rowId, [(columnId, formula), …]), …]
+    Returns row updates holding only the cells whose formula changed.
+    Pure CPU on plain data, so it can run in a worker process."""
+    # one alternation over every old token -> a single scan per formula
+    pattern = re.compile(r'\{(' + '|'.join(map(re.escape, repl_map)) + r')\}')
+
+    def patched(text: str) -> str:
+        missing = {}  # oldName -> new tokens this formula does not reference yet
+        def repl(m):
+            old = m.group(1)
+            if old not in missing:
+                missing[old] = [n for n in repl_map[old] if f"{{{n}}}" not in text]
+            return m.group(0) + "".join(f", {{{n}}}" for n in missing[old])
+        return pattern.sub(repl, text)
+
+    updates = []
+    for row_id, formulas in rows:
+        cells = []
+        for col_id, formula in formulas:
+            newf = patched(formula)
+            if newf != formula:
+                cells.append({"columnId": col_id, "formula": newf})
+        if cells:
+            updates.append({"id": row_id, "cells": cells})
+    return updates
+
 async def process_rollup(rollup_id: int, mapping: dict, dry: bool):
     # --- 1️⃣ pull refs & formulas (very small payload) ---
-    refs_result = await safe(SDK.Sheets.list_cross_sheet_references, rollup_id)
-    refs = refs_result.data if hasattr(refs_result, 'data') else refs_result
+    refs = (await ss_client.list_xrefs(rollup_id)).get("data", [])
     
-    sheet = await safe(SDK.Sheets.get_sheet, rollup_id, include="formulas", level=1)
+    sheet = await ss_client.get_sheet(rollup_id, include="formulas", level=1)
+    rows = sheet.get("rows", [])
 
     # active tokens present in formulas
-    formulas = [c.formula for r in sheet.rows for c in r.cells if c.formula]
-    active_tokens = set(re.findall(r'\{([^{}]+)\}', " ".join(formulas)))
+    active_tokens = {m.group(1)
+                     for r in rows for c in r.get("cells", []) if c.get("formula")
+                     for m in _TOKEN_RE.finditer(c["formula"])}
 
-    # map sourceSheetId -> [reference objects used in formulas]
+    # map sourceSheetId -> [(name, bounds) of references used in formulas]
     src_to_refs = {}
     for r in refs:
-        if r.name in active_tokens:
-            src_to_refs.setdefault(r.source_sheet_id, []).append(r)
+        if r["name"] in active_tokens:
+            bounds = {k: r[k] for k in REF_BOUNDS if k in r}
+            src_to_refs.setdefault(r["sourceSheetId"], []).append((r["name"], bounds))
+    existing_src_ids = {r["sourceSheetId"] for r in refs}
 
     # --- 2️⃣ clone missing references ---
-    repl_map = {}  # oldName -> [newName, …]
+    to_create = []  # (oldName, new reference body)
     for src_id, ref_list in src_to_refs.items():
         dup_ids = mapping.get(str(src_id), [])[1:]           # skip template itself
         for dup in dup_ids:
-            if dup in [r.source_sheet_id for r in refs]:
+            if dup in existing_src_ids:
                 continue  # ref already exists
-            for ref in ref_list:     # same bounds for every dup
-                new_ref = await safe(
-                    SDK.Sheets.create_cross_sheet_reference,
-                    rollup_id,
-                    SDK.models.CrossSheetReference({
-                        "name": f"{ref.name}-dup-{dup[-4:]}",
-                        "source_sheet_id": dup,
-                        "start_row_id": ref.start_row_id,
-                        "end_row_id": ref.end_row_id,
-                        "start_column_id": ref.start_column_id,
-                        "end_column_id": ref.end_column_id
-                    })
-                )                    # only *create* is allowed, not edit :contentReference[oaicite:3]{index=3}
-                repl_map.setdefault(ref.name, []).append(new_ref.data.name)
+            for name, bounds in ref_list:     # same bounds for every dup
+                to_create.append((name, {
+                    "name": f"{name}-dup-{str(dup)[-4:]}",
+                    "sourceSheetId": dup,
+                    **bounds
+                }))
+
+    # one write at a time: the API rejects concurrent writes to the same sheet
+    # (4004); roll-ups still run in parallel with each other in main()
+    # only *create* is allowed, not edit :contentReference[oaicite:3]{index=3}
+    repl_map = {}  # oldName -> [newName, …]
+    for name, body in to_create:
+        try:
+            new_ref = await ss_client.create_xref(rollup_id, body)
+        except Exception as e:
+            # keep what was created so its formulas still get patched
+            print(f"Roll‑up {rollup_id}: could not create {body['name']}: {e}")
+            continue
+        repl_map.setdefault(name, []).append(new_ref["name"])
 
     if not repl_map:
         print(f"Roll‑up {rollup_id}: nothing to update"); return
 
-    # --- 3️⃣ patch formulas in‑memory ---
-    def patched(text: str) -> str:
-        out = text
-        for old, news in repl_map.items():
-            for new in news:
-                out = out if f"{{{new}}}" in out else out.replace(
-                    f"{{{old}}}", f"{{{old}}}, {{{new}}}")
-        return out
-
-    updates = []
-    for row in sheet.rows:
-        changed = False
-        for cell in row.cells:
-            if cell.formula:
-                newf = patched(cell.formula)
-                if newf != cell.formula:
-                    cell.formula = newf
-                    changed = True
-        if changed:
-            updates.append(row)
+    # --- 3️⃣ patch formulas in a worker process (only formula cells cross over) ---
+    formula_rows = [(r["id"], fs) for r in rows
+                    if (fs := [(c["columnId"], c["formula"])
+                               for c in r.get("cells", []) if c.get("formula")])]
+    loop = asyncio.get_running_loop()
+    updates = await loop.run_in_executor(pool(), _patch_rows, formula_rows, repl_map)
 
     # --- 4️⃣ send row updates in 490‑row chunks ---
     if dry:
@@ -92,7 +120,7 @@ async def process_rollup(rollup_id: int, mapping: dict, dry: bool):
         return
 
     for chunk in chunked(updates):
-        await safe(SDK.Sheets.update_rows, rollup_id, chunk)
+        await ss_client.update_rows(rollup_id, chunk)
     print(f"Roll‑up {rollup_id}: ✓ updated {len(updates)} rows")
 
 async def main():
@@ -103,7 +131,7 @@ async def main():
     ap.add_argument("--dry-run", action="store_true")
     args = ap.parse_args()
 
-    mapping = json.load(open(args.mapping))
+    mapping = load_mapping(args.mapping)
     rollups = []
     
     if not args.rollups:
@@ -112,8 +140,8 @@ async def main():
     elif args.rollups == "auto":
         # Use auto-detected rollup IDs
         try:
-            with open("auto_rollup_config.json") as f:
-                config = json.load(f)
+            with open("auto_rollup_config.json", "rb") as f:
+                config = orjson.loads(f.read())
                 rollups = config.get("auto_detected_rollup_ids", [])
                 print(f"📋 Using {len(rollups)} auto-detected rollup sheets")
         except FileNotFoundError:
@@ -128,7 +156,12 @@ async def main():
         print("⚠️ No rollup sheets found - nothing to update")
         return
 
-    await asyncio.gather(*(process_rollup(r, mapping, args.dry_run) for r in rollups))
+    try:
+        await asyncio.gather(*(process_rollup(r, mapping, args.dry_run) for r in rollups))
+    finally:
+        await ss_client.close()
+        if _POOL is not None:
+            _POOL.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())